@@ -1,20 +1,31 @@
 # app_streamlit_amf_v4.py
 # -*- coding: utf-8 -*-
 
+import hashlib
 import json
+import os
 import random
 import re
+import sqlite3
+import threading
+import xml.etree.ElementTree as ET
+import zipfile
+from datetime import datetime, timedelta
+from io import BytesIO
+from itertools import chain
+from operator import itemgetter
 from pathlib import Path
-from typing import List, Optional
+from typing import List, Optional, Tuple, Union
 
+import numpy as np
 import pandas as pd
 import streamlit as st
-from openpyxl import load_workbook
 
 # ==================== Configuration ====================
 APP_TITLE    = "Entraînement Certification AMF"
 DEFAULT_XLSX = "AMF.xlsx"        # Mets ici le nom exact de ton fichier (ou importe via la barre latérale)
 SHEET_NAME   = "V4"
+HEADER_SCAN_ROWS = 100           # "n°identifiant" est cherché dans les 100 premières lignes
 
 # Tailles des sessions
 QUIZ_SIZE     = 84               # Mode examen aléatoire
@@ -23,10 +34,16 @@ SPRINT_BATCH  = 2                # 2 questions par mini-batch
 SPRINT_COUNT  = 7                # 7 mini-batches => 14 questions
 
 # Fichiers de persistance (conservés entre exécutions)
-SEEN_FILE       = Path(".amf_seen_ids.json")      # questions vues (après correction)
-WRONG_FILE      = Path(".amf_wrong_ids.json")     # questions en erreur
+HISTORY_DB      = Path(".amf_history.db")         # SQLite : questions vues / en erreur
+SEEN_KIND       = "seen"                          # questions vues (après correction)
+WRONG_KIND      = "wrong"                         # questions en erreur
+SEEN_FILE       = Path(".amf_seen_ids.json")      # anciens fichiers JSON, importés une fois dans HISTORY_DB
+WRONG_FILE      = Path(".amf_wrong_ids.json")
 PROGRESS_FILE   = Path(".amf_progress.json")      # état du parcours 20x20 (ordre + curseur)
 SPRINT_FILE     = Path(".amf_sprint.json")        # état du sprint (ordre aléatoire + curseur)
+CACHE_DIR       = Path(".amf_cache")              # base parsée (pickle), par hash du contenu
+QUESTION_COLUMNS = ["id", "question", "A", "B", "C", "correct_idx", "correct_text", "correct_letter", "options"]
+CACHE_VERSION   = 4                               # à incrémenter si les colonnes du DataFrame changent
 
 # Compat Streamlit rerun
 try:
@@ -36,36 +53,56 @@ except AttributeError:
 
 
 # ==================== Helpers ====================
+_Q_PREFIX_RE = re.compile(r"^\s*\d+\s*-\s*")   # préfixe '123 - ' des énoncés
+_X = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"            # espaces de noms XLSX
+_R = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+_LETTERS     = frozenset({"A", "B", "C"})
+_YELLOW_RGB  = frozenset({"FFEB9C", "FFFF00", "FFFDEB", "FFF2CC"})                     # RGB 6 car.
+_YELLOW_ARGB = frozenset({"00" + c for c in _YELLOW_RGB} | {"FF" + c for c in _YELLOW_RGB})  # ARGB 8 car.
+_DATE_FMT_IDS = frozenset(range(14, 23)) | {45, 46, 47}               # formats de date intégrés à Excel
+_FMT_STRIP_RE = re.compile(r'".*?"|\[(?!hh?\]|mm?\]|ss?\])[^\]]*\]')  # littéraux et [codes] hors durées
+_DATE_TOKEN_RE = re.compile(r"(?<![_\\])[dmhysDMHYS]")
+_EXCEL_EPOCH = datetime(1899, 12, 30)
+
 def s(val) -> str:
     return "" if val is None else str(val).strip()
 
-def clean_question_text(txt: str) -> str:
+def is_date_format(code: Optional[str]) -> bool:
     """
-    Supprime un éventuel préfixe '123 - ' dans l'énoncé.
-    Ex: '961 - Le PSI ...' -> 'Le PSI ...'
+    Format personnalisé de date/heure (même règle qu'openpyxl : première section, hors littéraux).
     """
-    if not txt:
-        return ""
-    return re.sub(r"^\s*\d+\s*-\s*", "", txt).strip()
+    if not code:
+        return False
+    return _DATE_TOKEN_RE.search(_FMT_STRIP_RE.sub("", code.split(";")[0])) is not None
 
-def cell_is_yellow(cell) -> bool:
+def excel_serial_to_datetime(value: Union[int, float]):
+    """
+    Numéro de série Excel (système 1900) -> datetime, ou time pour une heure seule.
     """
-    Détecte si la cellule est surlignée en jaune (plusieurs formats Excel possibles).
+    day, fraction = divmod(value, 1)
+    diff = timedelta(milliseconds=round(fraction * 86400000))
+    if 0 <= value < 1 and diff.days == 0:
+        return (datetime.min + diff).time()
+    if 0 < value < 60:
+        day += 1  # 29/02/1900 fictif d'Excel
+    return _EXCEL_EPOCH + timedelta(days=day) + diff
+
+def fill_is_yellow(pattern_type: Optional[str], rgb: Optional[str], indexed: Optional[int]) -> bool:
     """
-    f = cell.fill
-    if not f or not f.fgColor:
+    Détecte si un remplissage (styles.xml) est un surlignage jaune (plusieurs formats Excel possibles).
+    """
+    if pattern_type is None or pattern_type == "none":  # pas de remplissage (cas courant)
         return False
 
-    rgb_val = getattr(f.fgColor, "rgb", None)
-    if rgb_val:
-        rgb_str = str(rgb_val).upper()
-        for pat in ["FFEB9C", "FFFF00", "FFFDEB", "FFF2CC", "FFFFFF00"]:
-            if pat in rgb_str:
-                return True
+    if rgb:
+        key = rgb.upper()
+        # ARGB exact (alpha 00/FF), sinon les 6 derniers caractères : RGB seul ou alpha quelconque (80FFFF00)
+        if key in _YELLOW_ARGB or key[-6:] in _YELLOW_RGB:
+            return True
 
     # Palette indexée (legacy)
-    if getattr(f.fgColor, "indexed", None) is not None:
-        return f.fgColor.indexed in (5, 6, 13, 27, 44)
+    if indexed is not None:
+        return indexed in (5, 6, 13, 27, 44)
 
     return False
 
@@ -78,8 +115,11 @@ def load_json(file_path: Path, default):
     return default
 
 def save_json(file_path: Path, obj) -> None:
+    # Écriture atomique : fichier temporaire puis remplacement (pas de JSON tronqué)
     try:
-        file_path.write_text(json.dumps(obj, ensure_ascii=False, indent=2), encoding="utf-8")
+        tmp = file_path.with_suffix(file_path.suffix + ".tmp")
+        tmp.write_bytes(json.dumps(obj, separators=(",", ":")).encode("utf-8"))  # format compact
+        os.replace(tmp, file_path)
     except Exception:
         pass
 
@@ -87,20 +127,90 @@ def load_json_ids(file_path: Path) -> set:
     data = load_json(file_path, [])
     return set(data) if isinstance(data, list) else set()
 
-def save_json_ids(file_path: Path, ids: set) -> None:
-    save_json(file_path, sorted(list(ids)))
+# Historique vu/erreurs : table SQLite ids(kind, id), une ligne par id.
+# Chaque correction n'écrit que les ids ajoutés/retirés (au lieu de réécrire toute la liste).
+# La connexion est partagée entre les sessions (threads) : tout accès passe par _history_lock().
+@st.cache_resource(show_spinner=False)
+def _history_lock() -> threading.Lock:
+    # En cache comme la connexion : un verrou de module serait recréé à chaque rerun
+    return threading.Lock()
+
+@st.cache_resource(show_spinner=False)
+def history_db() -> sqlite3.Connection:
+    conn = sqlite3.connect(str(HISTORY_DB), check_same_thread=False)  # partagée par les sessions
+    conn.execute("PRAGMA journal_mode=WAL")
+    imported = []
+    with conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS ids(kind TEXT, id INT, PRIMARY KEY(kind, id))")
+        # Reprise unique des anciens fichiers JSON
+        for kind, legacy in ((SEEN_KIND, SEEN_FILE), (WRONG_KIND, WRONG_FILE)):
+            if legacy.exists():
+                conn.executemany("INSERT OR IGNORE INTO ids(kind, id) VALUES (?, ?)",
+                                 [(kind, i) for i in load_json_ids(legacy)])
+                imported.append(legacy)
+    # Supprimés seulement une fois l'import validé (commit) ; un échec laisse le fichier pour la prochaine fois
+    for legacy in imported:
+        try:
+            legacy.unlink(missing_ok=True)
+        except Exception:
+            pass
+    return conn
+
+def load_history_ids(kind: str) -> set:
+    # Pas de repli sur set() : une erreur de lecture ne doit pas mettre en cache un historique vide
+    with _history_lock():
+        return {row[0] for row in history_db().execute("SELECT id FROM ids WHERE kind=?", (kind,))}
 
-def load_seen_ids() -> set:
-    return load_json_ids(SEEN_FILE)
+def add_history_ids(kind: str, current: set, ids: set) -> None:
+    """
+    Ajoute `ids` à l'historique `kind` ; `current` (ensemble en mémoire) est mis à jour sur place,
+    une fois l'écriture validée.
+    """
+    with _history_lock():
+        new = ids - current
+        if not new:
+            return
+        try:
+            with history_db() as conn:
+                conn.executemany("INSERT OR IGNORE INTO ids(kind, id) VALUES (?, ?)", [(kind, i) for i in new])
+        except Exception:
+            return  # écriture annulée : l'ensemble en mémoire reste conforme à la base
+        current |= new
+
+def remove_history_ids(kind: str, current: set, ids: set) -> None:
+    with _history_lock():
+        gone = ids & current
+        if not gone:
+            return
+        try:
+            with history_db() as conn:
+                conn.executemany("DELETE FROM ids WHERE kind=? AND id=?", [(kind, i) for i in gone])
+        except Exception:
+            return
+        current -= gone
+
+def clear_history_ids(kind: str) -> None:
+    try:
+        with _history_lock(), history_db() as conn:
+            conn.execute("DELETE FROM ids WHERE kind=?", (kind,))
+    except Exception:
+        pass
 
-def save_seen_ids(seen: set) -> None:
-    save_json_ids(SEEN_FILE, seen)
+# Ensembles lus une fois par processus, puis tenus à jour en mémoire (modifiés sur place).
+# La base étant commune à toutes les sessions, l'ensemble en mémoire l'est aussi.
+@st.cache_resource(show_spinner=False)
+def _seen_set() -> set:
+    return load_history_ids(SEEN_KIND)
 
-def load_wrong_ids() -> set:
-    return load_json_ids(WRONG_FILE)
+@st.cache_resource(show_spinner=False)
+def _wrong_set() -> set:
+    return load_history_ids(WRONG_KIND)
+
+def load_seen_ids() -> set:
+    return _seen_set()
 
-def save_wrong_ids(wrong: set) -> None:
-    save_json_ids(WRONG_FILE, wrong)
+def load_wrong_ids() -> set:
+    return _wrong_set()
 
 def load_progress() -> dict:
     # 20x20 : {"order":[ids...], "cursor": int}
@@ -120,128 +230,355 @@ def pick_quiz_ids(all_ids: List[int], seen: set, k: int) -> List[int]:
     """
     Privilégie les ids jamais vus, puis complète avec du random si pas assez.
     """
-    unseen = [i for i in all_ids if i not in seen]
-    random.shuffle(unseen)
-    chosen = unseen[:k]
-    if len(chosen) < k:
-        remaining = [i for i in all_ids if i not in chosen]
-        random.shuffle(remaining)
-        chosen += remaining[:(k - len(chosen))]
+    all_set = set(all_ids)
+    unseen = list(all_set - seen)  # différence d'ensembles (C), un seul parcours
+    if len(unseen) >= k:
+        return random.sample(unseen, k)  # tirage partiel, sans mélanger toute la liste
+    chosen = unseen
+    random.shuffle(chosen)
+    remaining = list(all_set.intersection(seen))  # = all_set - set(chosen)
+    chosen += random.sample(remaining, min(k - len(chosen), len(remaining)))
     return chosen
 
 
 # ==================== Chargement base ====================
-@st.cache_data(show_spinner=False)
-def load_questions_from_excel(xlsx_path: str, sheet_name: str = SHEET_NAME) -> pd.DataFrame:
+def content_key(data: bytes) -> str:
+    # Empreinte du contenu d'un classeur (clé des caches)
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def excel_cache_path(xlsx_name: str, sheet_name: str, xlsx_key: str) -> Path:
+    """
+    Chemin du cache disque : .amf_cache/{nom}-{hash(contenu, onglet)}.pkl
+    Toute modification du contenu change la clé : pas d'invalidation manuelle,
+    et un même fichier copié/renommé/réimporté retombe sur le même cache.
+    """
+    raw = f"{xlsx_key}|{sheet_name}|v{CACHE_VERSION}".encode("utf-8")
+    key = hashlib.blake2b(raw, digest_size=16).hexdigest()
+    return CACHE_DIR / f"{Path(xlsx_name).stem}-{key}.pkl"
+
+# cache_resource : un seul DataFrame partagé, sans copie ni pickling à chaque accès.
+# Il est en lecture seule dans toute l'application : ne jamais le modifier sur place.
+@st.cache_resource(show_spinner=False)
+def load_questions_from_excel(xlsx_path: str, sheet_name: str = SHEET_NAME,
+                              xlsx_key: Optional[str] = None,
+                              _xlsx_bytes: Optional[bytes] = None) -> pd.DataFrame:
     """
     Retourne un DataFrame:
-      id, question, A, B, C, correct_idx, correct_text
+      id, question, A, B, C, correct_idx, correct_text, correct_letter, options  (QUESTION_COLUMNS)
     La bonne réponse est repérée via le surlignage jaune.
+    Le résultat est aussi persisté sur disque (clé = hash du contenu) pour accélérer
+    les démarrages à froid.
+    Pour un fichier importé, `_xlsx_bytes` (non hashé par Streamlit) porte le contenu
+    et `xlsx_key` (hash de ce contenu) sert de clé de cache.
     """
-    wb = load_workbook(xlsx_path, data_only=True)
-    if sheet_name not in wb.sheetnames:
-        raise ValueError(f"Onglet introuvable: {sheet_name}")
-    ws = wb[sheet_name]
-
-    # Trouver la ligne après "n°identifiant"
-    start_row = 1
-    for i in range(1, ws.max_row + 1):
-        v = ws.cell(row=i, column=1).value
-        if v and s(v).lower().startswith("n°identifiant"):
-            start_row = i + 1
+    if _xlsx_bytes is None:
+        _xlsx_bytes = Path(xlsx_path).read_bytes()  # lu une fois : hash + parsing
+        xlsx_key = content_key(_xlsx_bytes)
+    cache_path = excel_cache_path(xlsx_path, sheet_name, xlsx_key)
+    if cache_path.exists():
+        try:
+            return pd.read_pickle(cache_path)
+        except Exception:
+            pass  # cache illisible -> on reparse
+
+    df = parse_questions_excel(_xlsx_bytes, sheet_name)
+    try:
+        CACHE_DIR.mkdir(exist_ok=True)
+        df.to_pickle(cache_path)
+    except Exception:
+        pass
+    return df
+
+def _col_index(ref: str) -> int:
+    # "C12" -> 3
+    n = 0
+    for ch in ref:
+        if ch.isdigit():
+            break
+        n = n * 26 + ord(ch) - 64
+    return n
+
+def xlsx_sheet_path(zf: zipfile.ZipFile, sheet_name: str) -> str:
+    """
+    Chemin de l'onglet dans l'archive (workbook.xml -> workbook.xml.rels).
+    """
+    wb = ET.fromstring(zf.read("xl/workbook.xml"))
+    rid = None
+    for sh in wb.iter(_X + "sheet"):
+        if sh.get("name") == sheet_name:
+            rid = sh.get(_R + "id")
             break
+    if rid is None:
+        raise ValueError(f"Onglet introuvable: {sheet_name}")
+
+    rels = ET.fromstring(zf.read("xl/_rels/workbook.xml.rels"))
+    for rel in rels:
+        if rel.get("Id") == rid:
+            target = rel.get("Target", "")
+            return target.lstrip("/") if target.startswith("/") else "xl/" + target
+    raise ValueError(f"Onglet introuvable: {sheet_name}")
 
-    records = []
-    for r in ws.iter_rows(min_row=start_row, max_row=ws.max_row):
-        rid = r[0].value
-        if rid is None or (isinstance(rid, str) and rid.strip() == ""):
+def xlsx_shared_strings(zf: zipfile.ZipFile) -> List[str]:
+    """
+    Table des chaînes partagées, indexée par position (texte simple ou runs enrichis).
+    """
+    if "xl/sharedStrings.xml" not in zf.namelist():
+        return []
+    strings = []
+    for _, el in ET.iterparse(zf.open("xl/sharedStrings.xml"), events=("end",)):
+        if el.tag != _X + "si":
             continue
-        try:
-            rid_int = int(s(rid))
-        except Exception:
+        parts = []
+        for child in el:  # <t> ou <r><t> ; on ignore la phonétique <rPh>
+            if child.tag == _X + "t":
+                parts.append(child.text or "")
+            elif child.tag == _X + "r":
+                t = child.find(_X + "t")
+                if t is not None:
+                    parts.append(t.text or "")
+        strings.append("".join(parts))
+        el.clear()
+    return strings
+
+def xlsx_cell_styles(zf: zipfile.ZipFile) -> Tuple[List[bool], List[bool]]:
+    """
+    Pour chaque style de cellule (attribut s=) : remplissage jaune ?, format de date ?
+    Calculé une fois : la détection par cellule devient une simple indexation.
+    """
+    if "xl/styles.xml" not in zf.namelist():
+        return [], []
+    root = ET.fromstring(zf.read("xl/styles.xml"))
+
+    date_fmts = set(_DATE_FMT_IDS)
+    fmts_el = root.find(_X + "numFmts")
+    for fmt in (fmts_el if fmts_el is not None else []):
+        if is_date_format(fmt.get("formatCode")):
+            date_fmts.add(int(fmt.get("numFmtId")))
+
+    fills = []
+    fills_el = root.find(_X + "fills")
+    for fill in (fills_el if fills_el is not None else []):
+        pf = fill.find(_X + "patternFill")
+        if pf is None:
+            fills.append(False)
             continue
-
-        q_text_raw = s(r[1].value)
-        q_text = clean_question_text(q_text_raw)  # Nettoyage de la double numérotation
-        A = s(r[2].value)
-        B = s(r[3].value)
-        C = s(r[4].value)
-
-        # Détection de la bonne réponse via la couleur
-        correct_idx = None
-        for idx, c in enumerate([r[2], r[3], r[4]]):
-            try:
-                if cell_is_yellow(c):
+        fg = pf.find(_X + "fgColor")
+        rgb = fg.get("rgb") if fg is not None else None
+        indexed = fg.get("indexed") if fg is not None else None
+        fills.append(fill_is_yellow(pf.get("patternType"), rgb,
+                                    int(indexed) if indexed is not None else None))
+
+    yellow, dates = [], []
+    xfs_el = root.find(_X + "cellXfs")
+    for xf in (xfs_el if xfs_el is not None else []):
+        fill_id = int(xf.get("fillId", 0))
+        yellow.append(fill_id < len(fills) and fills[fill_id])
+        dates.append(int(xf.get("numFmtId", 0)) in date_fmts)
+    return yellow, dates
+
+def xlsx_iter_rows(zf: zipfile.ZipFile, sheet_path: str, shared: List[str],
+                   yellow_styles: List[bool], date_styles: List[bool], max_col: int = 5):
+    """
+    Flux des lignes de l'onglet : (n° de ligne, valeurs[max_col], jaune[max_col]).
+    Valeurs en cache (équivalent data_only, dates converties) ; mémoire bornée via iterparse + clear().
+    """
+    row_tag, c_tag, v_tag, is_tag, t_tag = _X + "row", _X + "c", _X + "v", _X + "is", _X + "t"
+    row_num = 0
+    for _, el in ET.iterparse(zf.open(sheet_path), events=("end",)):
+        if el.tag != row_tag:
+            continue
+        row_num = int(el.get("r", row_num + 1))
+        values = [None] * max_col
+        yellow = [False] * max_col
+        col = 0
+        for c in el.iter(c_tag):
+            ref = c.get("r")
+            col = _col_index(ref) if ref else col + 1
+            if col > max_col:
+                break
+
+            t = c.get("t")
+            style = int(c.get("s", 0))
+            if t == "inlineStr":
+                is_el = c.find(is_tag)
+                val = "".join(x.text or "" for x in is_el.iter(t_tag)) if is_el is not None else None
+            else:
+                v_el = c.find(v_tag)
+                raw = v_el.text if v_el is not None else None
+                if not raw:
+                    val = None
+                elif t == "s":
+                    val = shared[int(raw)]
+                elif t == "b":
+                    val = raw == "1"
+                elif t in ("str", "e"):
+                    val = raw
+                elif t == "d":  # date ISO 8601
+                    try:
+                        val = datetime.fromisoformat(raw)
+                    except ValueError:
+                        val = raw
+                else:  # nombre
+                    try:
+                        val = float(raw) if ("." in raw or "E" in raw or "e" in raw) else int(raw)
+                        if style < len(date_styles) and date_styles[style]:
+                            val = excel_serial_to_datetime(val)
+                    except (ValueError, OverflowError):
+                        val = raw  # valeur inattendue : une cellule ne doit pas rendre le classeur illisible
+            values[col - 1] = val
+
+            yellow[col - 1] = style < len(yellow_styles) and yellow_styles[style]
+
+        yield row_num, values, yellow
+        el.clear()
+
+def parse_questions_excel(src: Union[str, bytes], sheet_name: str) -> pd.DataFrame:
+    """
+    Lecture effective de l'Excel, sans cache.
+    `src` est un chemin ou le contenu brut du fichier.
+    Lecture directe du XML (sharedStrings / styles / feuille) : on n'a besoin que de
+    5 colonnes et d'une couleur de remplissage, pas du modèle objet complet d'openpyxl.
+    """
+    with zipfile.ZipFile(BytesIO(src) if isinstance(src, (bytes, bytearray)) else src) as zf:
+        sheet_path = xlsx_sheet_path(zf, sheet_name)
+        shared = xlsx_shared_strings(zf)
+        yellow_styles, date_styles = xlsx_cell_styles(zf)
+
+        # Un seul flux de lignes : on cherche "n°identifiant" dans les premières lignes
+        # puis on poursuit le même flux.
+        rows = xlsx_iter_rows(zf, sheet_path, shared, yellow_styles, date_styles)
+        head = []  # lignes déjà lues, rejouées si aucun en-tête n'est trouvé
+        for row in rows:
+            v = row[1][0]
+            if v and str(v).strip().lower().startswith("n°identifiant"):
+                head = []
+                break
+            head.append(row)
+            if row[0] >= HEADER_SCAN_ROWS:
+                break
+
+        # Colonnes brutes en parallèle (une liste par colonne) ; nettoyage ensuite en bloc (pandas)
+        ids, qraw, As, Bs, Cs, cidx = [], [], [], [], [], []
+        for _, values, yellow in chain(head, rows):
+            rid = values[0]
+            if rid is None:
+                continue
+            if isinstance(rid, int):  # cas courant : aucun travail sur chaîne
+                rid_int = rid
+            elif isinstance(rid, float):
+                if not rid.is_integer():
+                    continue
+                rid_int = int(rid)
+            else:
+                t = str(rid).strip()
+                if not t.lstrip("-").isdigit():
+                    continue
+                rid_int = int(t)
+
+            q_raw = s(values[1])
+            if not q_raw:
+                continue  # énoncé vide : filtré dès la lecture
+
+            # Bonne réponse via la couleur (premier jaune trouvé parmi C/D/E, -1 sinon)
+            correct_idx = -1
+            for idx in range(3):
+                if yellow[idx + 2]:
                     correct_idx = idx
                     break
-            except Exception:
-                pass
-
-        correct_text = [A, B, C][correct_idx] if correct_idx is not None else ""
-        if q_text:
-            records.append({
-                "id": rid_int, "question": q_text,
-                "A": A, "B": B, "C": C,
-                "correct_idx": correct_idx,
-                "correct_text": correct_text
-            })
-
-    df = pd.DataFrame.from_records(records)
-    if not df.empty:
-        df = df[df["question"] != ""]
+
+            ids.append(rid_int)
+            qraw.append(q_raw)
+            As.append(s(values[2]))
+            Bs.append(s(values[3]))
+            Cs.append(s(values[4]))
+            cidx.append(correct_idx)
+
+    if not ids:  # aucune question : colonnes attendues, sans lignes
+        return pd.DataFrame(columns=QUESTION_COLUMNS)
+
+    ci = np.array(cidx, dtype=np.int64)
+    df = pd.DataFrame({
+        "id": ids, "question": qraw,
+        "A": As, "B": Bs, "C": Cs,
+        "correct_idx": pd.Series(ci).where(ci >= 0).astype("Int64"),  # <NA> si non détectée
+    })
+    # Nettoyage de la double numérotation, sur toute la colonne
+    df["question"] = df["question"].str.replace(_Q_PREFIX_RE, "", regex=True).str.strip()
+    choices = np.stack([df["A"].to_numpy(dtype=object), df["B"].to_numpy(dtype=object),
+                        df["C"].to_numpy(dtype=object)])
+    df["correct_text"] = np.where(ci >= 0, choices[np.clip(ci, 0, 2), np.arange(len(df))], "")
+    # Dérivés calculés une fois ici plutôt qu'à chaque rerun (rendu / correction)
+    letters = np.where(ci >= 0, np.array(["A", "B", "C"], dtype=object)[np.clip(ci, 0, 2)], None)
+    df["correct_letter"] = pd.Series(letters, dtype=object)  # object : None (et non NaN) si non détectée
+    df["options"] = [[f"A) {a}", f"B) {b}", f"C) {c}"] for a, b, c in zip(df["A"], df["B"], df["C"])]
+    # Seuls les énoncés réduits au préfixe '123 - ' restent à écarter : copie uniquement si besoin
+    empty = df["question"] == ""
+    if empty.any():
+        df = df[~empty].reset_index(drop=True)
     return df
 
+@st.cache_resource(show_spinner=False)
+def build_id_index(df: pd.DataFrame) -> dict:
+    """
+    Index id -> ligne (dict) calculé une fois : évite un set_index/loc à chaque rerun.
+    """
+    return {int(r.id): r._asdict() for r in df.itertuples(index=False)}
+
 
 # ==================== Thème sombre (forcé) ====================
-def style_dark():
+# Le script est ré-exécuté à chaque rerun : la feuille de style est mise en cache
+# pour n'être construite qu'une fois par processus (elle reste émise à chaque rerun).
+@st.cache_resource(show_spinner=False)
+def dark_css() -> str:
     css_vars = dict(
         bg="#0b1020", text="#e5e7eb", card="#111827", border="rgba(255,255,255,.15)",
         correct_bg="rgba(16,185,129,0.18)", correct_border="#34d399",
         wrong_bg="rgba(239,68,68,0.20)", wrong_border="#f87171",
         muted="#9ca3af"
     )
-    st.markdown(
-        f"""
-        <style>
-        .main .block-container {{max-width: 980px;}}
-        html, body, [data-testid="stAppViewContainer"] {{
-            background: {css_vars['bg']} !important;
-            color: {css_vars['text']} !important;
-        }}
-        .question-card {{
-            border: 1px solid {css_vars['border']};
-            border-radius: 14px;
-            padding: 16px 18px;
-            margin-bottom: 14px;
-            background: {css_vars['card']};
-            box-shadow: 0 1px 3px rgba(0,0,0,0.06);
-        }}
-        .question-title {{ font-weight: 700; margin-bottom: 10px; }}
-        .qid-badge {{
-            font-size: 12px; color: {css_vars['muted']}; margin-top: -6px; margin-bottom: 6px;
-        }}
-        .correct {{
-            background: {css_vars['correct_bg']};
-            border-left: 6px solid {css_vars['correct_border']};
-            padding: 12px 14px; border-radius: 10px; color: inherit;
-        }}
-        .wrong {{
-            background: {css_vars['wrong_bg']};
-            border-left: 6px solid {css_vars['wrong_border']};
-            padding: 12px 14px; border-radius: 10px; color: inherit;
-        }}
-        .muted {{ color: {css_vars['muted']}; }}
-        .pill {{
-            display: inline-block; padding: 2px 8px; border-radius: 999px;
-            font-size: 11px; font-weight: 700; border: 1px solid {css_vars['border']};
-            margin-right: 6px;
-        }}
-        .ans-line {{ margin: 2px 0 2px 0; }}
-        .ans-label {{ font-weight: 700; width: 28px; display: inline-block; }}
-        </style>
-        """,
-        unsafe_allow_html=True
-    )
+    return f"""
+    <style>
+    .main .block-container {{max-width: 980px;}}
+    html, body, [data-testid="stAppViewContainer"] {{
+        background: {css_vars['bg']} !important;
+        color: {css_vars['text']} !important;
+    }}
+    .question-card {{
+        border: 1px solid {css_vars['border']};
+        border-radius: 14px;
+        padding: 16px 18px;
+        margin-bottom: 14px;
+        background: {css_vars['card']};
+        box-shadow: 0 1px 3px rgba(0,0,0,0.06);
+    }}
+    .question-title {{ font-weight: 700; margin-bottom: 10px; }}
+    .qid-badge {{
+        font-size: 12px; color: {css_vars['muted']}; margin-top: -6px; margin-bottom: 6px;
+    }}
+    .correct {{
+        background: {css_vars['correct_bg']};
+        border-left: 6px solid {css_vars['correct_border']};
+        padding: 12px 14px; border-radius: 10px; color: inherit;
+    }}
+    .wrong {{
+        background: {css_vars['wrong_bg']};
+        border-left: 6px solid {css_vars['wrong_border']};
+        padding: 12px 14px; border-radius: 10px; color: inherit;
+    }}
+    .muted {{ color: {css_vars['muted']}; }}
+    .pill {{
+        display: inline-block; padding: 2px 8px; border-radius: 999px;
+        font-size: 11px; font-weight: 700; border: 1px solid {css_vars['border']};
+        margin-right: 6px;
+    }}
+    .ans-line {{ margin: 2px 0 2px 0; }}
+    .ans-label {{ font-weight: 700; width: 28px; display: inline-block; }}
+    </style>
+    """
+
+def style_dark():
+    # Ré-émise à chaque rerun : Streamlit retire tout élément non redessiné
+    st.markdown(dark_css(), unsafe_allow_html=True)
 
 
 # ==================== UI ====================
@@ -260,7 +597,7 @@ def sidebar_controls(df: pd.DataFrame):
     if prev_mode is None:
         st.session_state["mode_prev"] = mode
     elif prev_mode != mode:
-        for k in ["quiz_started", "submitted", "review_wrong_only", "quiz_ids", "answers",
+        for k in ["quiz_started", "submitted", "review_wrong_only", "quiz_ids", "_rows", "answers",
                   "cursor", "order_len", "mark_review"]:
             st.session_state.pop(k, None)
         st.session_state["mode_prev"] = mode
@@ -268,18 +605,33 @@ def sidebar_controls(df: pd.DataFrame):
 
     # Uploader Excel
     uploaded = st.sidebar.file_uploader("Importer un fichier Excel AMF", type=["xlsx"])
+    # Le fichier reste dans l'uploader à chaque rerun : on ne relit/rehashe son contenu
+    # que pour un nouvel envoi (identifiant d'upload différent).
+    upload_id = None
     if uploaded is not None:
-        tmp_path = Path("uploaded_amf.xlsx")
-        with open(tmp_path, "wb") as f:
-            f.write(uploaded.getbuffer())
-        st.session_state["xlsx_path"] = str(tmp_path)
-        st.sidebar.success("Fichier importé. Recharge en cours…")
-        RERUN()
+        upload_id = getattr(uploaded, "file_id", None) or (uploaded.name, uploaded.size)
+    if upload_id is not None and st.session_state.get("xlsx_upload_id") != upload_id:
+        st.session_state["xlsx_upload_id"] = upload_id
+        # Lu directement en mémoire (pas de copie disque) ; clé = hash du contenu
+        data = uploaded.getvalue()
+        key = content_key(data)
+        if st.session_state.get("xlsx_key") != key:
+            st.session_state["xlsx_path"] = uploaded.name
+            st.session_state["xlsx_bytes"] = data
+            st.session_state["xlsx_key"] = key
+            st.session_state.pop("_df", None)  # base à recharger
+            # Le test en cours porte sur l'ancienne base : on repart de zéro
+            for k in ["quiz_started", "submitted", "review_wrong_only", "quiz_ids", "_rows", "answers", "mark_review"]:
+                st.session_state.pop(k, None)
+            clear_quiz_widgets()
+            st.sidebar.success("Fichier importé. Recharge en cours…")
+            RERUN()
 
     st.sidebar.write("")
     if st.sidebar.button("🔁 Nouveau test", use_container_width=True):
-        for k in ["quiz_started", "submitted", "review_wrong_only", "quiz_ids", "answers", "mark_review"]:
+        for k in ["quiz_started", "submitted", "review_wrong_only", "quiz_ids", "_rows", "answers", "mark_review"]:
             st.session_state.pop(k, None)
+        clear_quiz_widgets()
         # On ne touche pas aux fichiers de progression ici
         RERUN()
 
@@ -294,12 +646,14 @@ def sidebar_controls(df: pd.DataFrame):
 
     st.sidebar.write("---")
     if st.sidebar.button("🧹 Réinitialiser l'historique (vu)", use_container_width=True):
-        if SEEN_FILE.exists(): SEEN_FILE.unlink(missing_ok=True)
+        clear_history_ids(SEEN_KIND)
+        _seen_set.clear()
         st.sidebar.success("Historique 'vu' effacé.")
         RERUN()
 
     if st.sidebar.button("🧹 Réinitialiser mes erreurs", use_container_width=True):
-        if WRONG_FILE.exists(): WRONG_FILE.unlink(missing_ok=True)
+        clear_history_ids(WRONG_KIND)
+        _wrong_set.clear()
         st.sidebar.success("Liste d'erreurs effacée.")
         RERUN()
 
@@ -310,6 +664,16 @@ def sidebar_controls(df: pd.DataFrame):
 
 
 # ==================== Démarrage des modes ====================
+def clear_quiz_widgets() -> None:
+    """
+    Supprime l'état des widgets des tests précédents (q_<id>, mark_<id>) :
+    sans cela ils s'accumulent dans la session et pré-remplissent une question revue.
+    """
+    stale = [k for k in st.session_state
+             if k.startswith("q_") or (k.startswith("mark_") and k[5:].lstrip("-").isdigit())]
+    for k in stale:
+        del st.session_state[k]
+
 def start_quiz_examen(df: pd.DataFrame):
     all_ids = df["id"].tolist()
     if st.session_state.get("review_wrong_only"):
@@ -319,7 +683,10 @@ def start_quiz_examen(df: pd.DataFrame):
         seen = load_seen_ids()
         chosen_ids = pick_quiz_ids(all_ids, seen, QUIZ_SIZE)
 
+    clear_quiz_widgets()
     st.session_state["quiz_ids"] = chosen_ids
+    idx = build_id_index(df)
+    st.session_state["_rows"] = [idx[i] for i in chosen_ids]  # lignes du batch, figées jusqu'au prochain
     st.session_state["answers"] = {}            # id -> "A"/"B"/"C" ou None
     st.session_state["mark_review"] = {}        # id -> True/False
     st.session_state["submitted"] = False
@@ -341,7 +708,10 @@ def start_quiz_parcours(df: pd.DataFrame):
     end = min(cursor + BATCH_SIZE, len(order))
     chosen_ids = order[cursor:end]
 
+    clear_quiz_widgets()
     st.session_state["quiz_ids"] = chosen_ids
+    idx = build_id_index(df)
+    st.session_state["_rows"] = [idx[i] for i in chosen_ids]  # lignes du batch, figées jusqu'au prochain
     st.session_state["answers"] = {}
     st.session_state["mark_review"] = {}
     st.session_state["submitted"] = False
@@ -366,7 +736,10 @@ def start_quiz_sprint(df: pd.DataFrame):
     end = min(cursor + SPRINT_BATCH, len(order))
     chosen_ids = order[cursor:end]
 
+    clear_quiz_widgets()
     st.session_state["quiz_ids"] = chosen_ids
+    idx = build_id_index(df)
+    st.session_state["_rows"] = [idx[i] for i in chosen_ids]  # lignes du batch, figées jusqu'au prochain
     st.session_state["answers"] = {}
     st.session_state["mark_review"] = {}
     st.session_state["submitted"] = False
@@ -379,7 +752,7 @@ def start_quiz_sprint(df: pd.DataFrame):
 def render_progress_bar():
     ids = st.session_state.get("quiz_ids", [])
     answers = st.session_state.get("answers", {})
-    answered = sum(1 for qid in ids if answers.get(qid) in ["A", "B", "C"])
+    answered = sum(1 for qid in ids if answers.get(qid) in _LETTERS)
     st.progress(answered / max(len(ids), 1))
     st.caption(f"Répondu : {answered} / {len(ids)}")
 
@@ -388,17 +761,20 @@ def render_quiz(df: pd.DataFrame):
     ids = st.session_state["quiz_ids"]
     answers = st.session_state["answers"]
     marks   = st.session_state["mark_review"]
-    rows = df.set_index("id").loc[ids].reset_index()
+    rows = st.session_state["_rows"]
 
     render_progress_bar()
 
-    for i, row in rows.iterrows():
+    for i, row in enumerate(rows):
         qid = int(row["id"])
-        options = [f"A) {row['A']}", f"B) {row['B']}", f"C) {row['C']}"]
+        options = row["options"]
 
-        st.markdown("<div class='question-card'>", unsafe_allow_html=True)
-        st.markdown(f"<div class='question-title'>Q{i+1}/{len(ids)}. {row['question']}</div>", unsafe_allow_html=True)
-        st.markdown(f"<div class='qid-badge'>ID: {qid}</div>", unsafe_allow_html=True)
+        # Carte énoncé + badge en un seul élément (un seul aller-retour Streamlit)
+        st.markdown(
+            f"<div class='question-card'><div class='question-title'>Q{i+1}/{len(ids)}. {row['question']}</div>"
+            f"<div class='qid-badge'>ID: {qid}</div></div>",
+            unsafe_allow_html=True
+        )
 
         # Radio sans présélection : on ajoute un placeholder en première option
         radio_options = ["— Choisir —"] + options
@@ -415,15 +791,8 @@ def render_quiz(df: pd.DataFrame):
             key=f"q_{qid}"
         )
 
-        chosen_letter: Optional[str] = None
-        if selection.startswith("A)"):
-            chosen_letter = "A"
-        elif selection.startswith("B)"):
-            chosen_letter = "B"
-        elif selection.startswith("C)"):
-            chosen_letter = "C"
-        else:
-            chosen_letter = None
+        # Options au format "A) ...", placeholder "— Choisir —" -> None
+        chosen_letter: Optional[str] = selection[0] if selection and selection[0] in _LETTERS else None
 
         st.session_state["answers"][qid] = chosen_letter
 
@@ -431,8 +800,6 @@ def render_quiz(df: pd.DataFrame):
         mark = st.checkbox("📌 Marquer à revoir", key=f"mark_{qid}", value=marks.get(qid, False))
         st.session_state["mark_review"][qid] = mark
 
-        st.markdown("</div>", unsafe_allow_html=True)
-
     st.write("")
     if st.button("🟡 Voir les réponses", type="primary", use_container_width=True):
         st.session_state["submitted"] = True
@@ -446,49 +813,49 @@ def grade_and_show_results(df: pd.DataFrame):
         st.warning("Aucune question chargée.")
         return
 
-    rows = df.set_index("id").loc[ids].reset_index()
+    rows = st.session_state["_rows"]  # figées au démarrage du batch
 
     score = 0
     details = []
-    wrong_ids_set = load_wrong_ids()
+    ok_ids, ko_ids, graded_ids = set(), set(), set()  # appliqués en bloc après la boucle
 
-    for _, row in rows.iterrows():
+    for row in rows:
         qid = int(row["id"])
-        correct_idx = row["correct_idx"]
-        correct_letter = ["A", "B", "C"][correct_idx] if pd.notna(correct_idx) and correct_idx in [0, 1, 2] else None
+        correct_letter = row["correct_letter"]  # None si non détectée
         user_letter = answers.get(qid)  # None si non répondu
 
         correct = (user_letter is not None and user_letter == correct_letter)
         if correct:
             score += 1
-            if qid in wrong_ids_set:
-                wrong_ids_set.remove(qid)
+            ok_ids.add(qid)
         else:
-            wrong_ids_set.add(qid)
+            ko_ids.add(qid)
 
         # Forcer en "à revoir" si coché
         if marks.get(qid):
-            wrong_ids_set.add(qid)
+            ko_ids.add(qid)
+
+        if correct_letter is not None:
+            graded_ids.add(qid)
 
-        details.append((qid, row["question"], user_letter, correct_letter, row["A"], row["B"], row["C"]))
+        is_ok = (user_letter == correct_letter)
+        details.append((is_ok, qid, row["question"], user_letter, correct_letter, row["A"], row["B"], row["C"]))
 
     # Sauvegarde erreurs & “vues” (uniquement à la correction)
-    save_wrong_ids(wrong_ids_set)
-
-    seen = load_seen_ids()
-    for (qid, _, _, correct_letter, *_rest) in details:
-        if correct_letter is not None:
-            seen.add(qid)
-    save_seen_ids(seen)
+    # (seuls les ids qui changent sont écrits ; rien aux reruns suivants)
+    wrong_ids_set = load_wrong_ids()
+    remove_history_ids(WRONG_KIND, wrong_ids_set, ok_ids - ko_ids)
+    add_history_ids(WRONG_KIND, wrong_ids_set, ko_ids)
+    add_history_ids(SEEN_KIND, load_seen_ids(), graded_ids)
 
     # En-tête score
     st.subheader("Résultats")
     st.markdown(f"### Score : **{score} / {len(ids)}**")
 
     # Afficher d'abord les erreurs, puis les bonnes
-    details_sorted = sorted(details, key=lambda x: (x[2] == x[3], ))  # Faux/None en premier
+    details.sort(key=itemgetter(0))  # Faux/None en premier (tri stable)
 
-    for (qid, qtext, user_letter, correct_letter, A, B, C) in details_sorted:
+    for (is_ok, qid, qtext, user_letter, correct_letter, A, B, C) in details:
         if correct_letter is None:
             st.markdown(
                 f"<div class='wrong'><b>ID {qid}.</b> {qtext}<br>"
@@ -497,16 +864,14 @@ def grade_and_show_results(df: pd.DataFrame):
             )
             continue
 
-        is_ok = (user_letter == correct_letter)
         box_class = "correct" if is_ok else "wrong"
         st.markdown(f"<div class='{box_class}'><b>ID {qid}.</b> {qtext}</div>", unsafe_allow_html=True)
 
-        mapping = {"A": A, "B": B, "C": C}
         # Lignes de réponses : ✅ Bonne / 🔘 Ta réponse si fausse
         lines = []
-        for letter in ["A", "B", "C"]:
+        for letter, text in zip(("A", "B", "C"), (A, B, C)):
             icon = "✅" if letter == correct_letter else ("🔘" if user_letter == letter and user_letter != correct_letter else "")
-            text = mapping[letter] if mapping[letter] else "—"
+            text = text if text else "—"
             lines.append(f"<div class='ans-line'><span class='ans-label'>{letter})</span> {icon} {text}</div>")
         st.markdown("<div style='margin:6px 0 16px 12px;'>" + "".join(lines) + "</div>", unsafe_allow_html=True)
 
@@ -573,18 +938,27 @@ def main():
     if "xlsx_path" not in st.session_state:
         st.session_state["xlsx_path"] = DEFAULT_XLSX
 
-    xlsx_path = st.session_state["xlsx_path"]
-    if not Path(xlsx_path).exists():
-        st.info(f"Place le fichier **{DEFAULT_XLSX}** à côté du script ou importe-le via la barre latérale.")
-        sidebar_controls(pd.DataFrame({"question": []}))
-        return
+    # Charger base (une seule fois par session : les reruns réutilisent le DataFrame,
+    # sans même retoucher au système de fichiers)
+    df = st.session_state.get("_df")
+    if df is None:
+        xlsx_path = st.session_state["xlsx_path"]
+        xlsx_bytes = st.session_state.get("xlsx_bytes")  # fichier importé via la barre latérale
+        if xlsx_bytes is None and not Path(xlsx_path).exists():
+            st.info(f"Place le fichier **{DEFAULT_XLSX}** à côté du script ou importe-le via la barre latérale.")
+            sidebar_controls(pd.DataFrame({"question": []}))
+            return
 
-    # Charger base
-    try:
-        df = load_questions_from_excel(xlsx_path, sheet_name=SHEET_NAME)
-    except Exception as e:
-        st.error(f"Impossible de lire le fichier Excel : {e}")
-        return
+        try:
+            if xlsx_bytes is not None:
+                df = load_questions_from_excel(xlsx_path, sheet_name=SHEET_NAME,
+                                               xlsx_key=st.session_state["xlsx_key"], _xlsx_bytes=xlsx_bytes)
+            else:
+                df = load_questions_from_excel(xlsx_path, sheet_name=SHEET_NAME)
+        except Exception as e:
+            st.error(f"Impossible de lire le fichier Excel : {e}")
+            return
+        st.session_state["_df"] = df
 
     sidebar_controls(df)
 